@@ -14,11 +14,22 @@
     @author Karl Cronburg <karl.cronburg@gmail.com>
 """
 import os
+import stat
 import sys
-import pandas
+import collections
+import heapq
+import itertools
+import mmap
+import multiprocessing
 import re
 import numpy as np
 
+numba_imported = True
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    numba_imported = False
+
 runascmd = False
 
 err = sys.stderr.write
@@ -67,23 +78,30 @@ class HistFileRdr():
     def curBins(self):
         return self.data[3:]
 
-def weighted_percentile(percs, vs, ws):
-    """ Use linear interpolation to calculate the weighted percentile.
+def weighted_stats(percs, vs, ws, presorted=False):
+    """ Calculate the weighted average and, using linear interpolation, the
+        weighted percentiles of a distribution in a single pass.
         
         Value and weight arrays are first sorted by value. The cumulative
         distribution function (cdf) is then computed, after which np.interp
         finds the two values closest to our desired weighted percentile(s)
-        and linearly interpolates them.
+        and linearly interpolates them. The total weight is shared by the
+        cdf and the average.
         
-        percs  :: List of percentiles we want to calculate
-        vs     :: Array of values we are computing the percentile of
-        ws     :: Array of weights for our corresponding values
-        return :: Array of percentiles
+        percs     :: List of percentiles we want to calculate
+        vs        :: Array of values we are computing the percentile of
+        ws        :: Array of weights for our corresponding values
+        presorted :: True if vs is already sorted (e.g. bin_vals), in which
+                     case the sort is skipped
+        return    :: (weighted average, array of percentiles)
     """
-    idx = np.argsort(vs)
-    vs, ws = vs[idx], ws[idx] # weights and values sorted by value
-    cdf = 100 * (ws.cumsum() - ws / 2.0) / ws.sum()
-    return np.interp(percs, cdf, vs) # linear interpolation
+    if not presorted:
+        idx = np.argsort(vs)
+        vs, ws = vs[idx], ws[idx] # weights and values sorted by value
+    total = ws.sum()
+    cdf = 100 * (ws.cumsum() - ws / 2.0) / total
+    avg = np.sum(vs * ws) / total
+    return avg, np.interp(percs, cdf, vs) # linear interpolation
 
 def weights(start_ts, end_ts, start, end):
     """ Calculate weights based on fraction of sample falling in the
@@ -101,16 +119,15 @@ def weights(start_ts, end_ts, start, end):
     """
     sbounds = np.maximum(start_ts, start).astype(float)
     ebounds = np.minimum(end_ts,   end).astype(float)
-    ws = (ebounds - sbounds) / (end_ts - start_ts)
-    if np.any(np.isnan(ws)):
+    dur = end_ts - start_ts
+    empty = dur <= 0
+    ws = (ebounds - sbounds) / np.where(empty, 1.0, dur)
+    if np.any(empty):
       err("WARNING: zero-length sample(s) detected. Log file corrupt"
           " / bad time values? Ignoring these samples.\n")
-    ws[np.where(np.isnan(ws))] = 0.0;
+      ws[np.broadcast_to(empty, ws.shape)] = 0.0
     return ws
 
-def weighted_average(vs, ws):
-    return np.sum(vs * ws) / np.sum(ws)
-
 
 percs = None
 columns = None
@@ -127,6 +144,17 @@ def gen_output_columns(ctx):
     columns.extend(list([x+'%' for x in strpercs]))
     columns.append("max")
 
+    # Format string of each output row, matching the columns above:
+    if ctx.directions:
+        ctx.row_fmt = "%d, %s, %d, "
+    else:
+        ctx.row_fmt = "%d, %d, "
+    if ctx.divisor > 1:
+        ctx.row_fmt += fmt_float_list(ctx, len(percs)+3)
+    else:
+        # max and min are decimal values if no divisor
+        ctx.row_fmt += "%d, " + fmt_float_list(ctx, len(percs)+1) + ", %d"
+
 def fmt_float_list(ctx, num=1):
   """ Return a comma separated list of float formatters to the required number
       of decimal places. For instance:
@@ -141,130 +169,200 @@ __HIST_COLUMNS = 1216
 __NON_HIST_COLUMNS = 3
 __TOTAL_COLUMNS = __HIST_COLUMNS + __NON_HIST_COLUMNS
 
-def read_chunk(rdr, sz):
-    """ Read the next chunk of size sz from the given reader. """
-    try:
-        """ StopIteration occurs when the pandas reader is empty, and AttributeError
-            occurs if rdr is None due to the file being empty. """
-        new_arr = rdr.read().values
-    except (StopIteration, AttributeError):
-        return None
-
-    # Let's leave the array as is, and let later code ignore the block size
-    return new_arr
+def is_empty_file(fp):
+    """ Check whether fp is an empty regular file. Pipes and other special
+        files always report a size of zero, so they are never considered
+        empty here. """
+    st = os.fstat(fp.fileno())
+    return stat.S_ISREG(st.st_mode) and st.st_size == 0
+
+class HistChunkRdr():
+    """ Class to read a hist file in chunks of whole lines, as bytes.
+        Regular files are memory mapped so that the kernel pages in the data
+        and no Python string is created per line. Files which cannot be
+        mapped (e.g. pipes) are read line by line instead.
+    """
+    def __init__(self, file):
+        self.fp = open(file, 'rb')
+        self.empty = is_empty_file(self.fp)
+        self.pos = 0
+        self.line_len = None
+        try:
+            self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self.mm = None
 
-    #""" Extract array of the times, directions wo times, and histograms matrix without times column. """
-    #times, rws, szs = new_arr[:,0], new_arr[:,1], new_arr[:,2]
-    #hists = new_arr[:,__NON_HIST_COLUMNS:]
-    #times = times.reshape((len(times),1))
-    #dirs  = rws.reshape((len(rws),1))
-    #arr = np.append(times, hists, axis=1)
-    #return arr
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.fp.close()
 
-def get_min(fps, arrs):
-    """ Find the file with the current first row with the smallest start time """
-    return min([fp for fp in fps if not arrs[fp] is None], key=lambda fp: arrs.get(fp)[0][0])
+    def read(self, sz):
+        """ Return the next (approximately) sz lines, or b'' at the end of
+            the file. """
+        if self.mm is None:
+            return b''.join(itertools.islice(self.fp, sz))
+
+        # Skip blank lines so that the chunk starts with a line of data:
+        while self.mm[self.pos:self.pos + 1].isspace():
+            self.pos += 1
+
+        # Lines are roughly the same length, so estimate where the sz'th
+        # line ends from the length of the first one and cut the chunk at
+        # the next newline from there:
+        if self.line_len is None:
+            self.line_len = self.mm.find(b'\n', self.pos) + 1 - self.pos
+            if self.line_len <= 0:
+                self.line_len = len(self.mm) - self.pos
+        end = self.mm.find(b'\n', self.pos + max(sz - 1, 0) * self.line_len)
+        end = len(self.mm) if end < 0 else end + 1
+        lines = self.mm[self.pos:end]
+        self.pos = end
+        return lines
+
+def read_chunk(rdr, sz, file_idx=0):
+    """ Read the next chunk of about sz lines from the given HistChunkRdr,
+        returning a (times, hists) pair of arrays with one row per line, or
+        None if the file has been exhausted. times holds the time, file_idx,
+        direction and block size columns and hists the int32 histogram
+        bins. """
+    # Blank lines are ignored, so keep reading until the chunk contains
+    # some data. They are rare, so only pay for a regex over the chunk
+    # when it actually has any, or does not end in a newline (i.e. is the
+    # last chunk of a file which may end in whitespace):
+    lines = b''
+    while not lines:
+        lines = rdr.read(sz)
+        if not lines:
+            return None
+        if lines[:1].isspace() or lines[-1:] != b'\n' or re.search(rb'\n\s*\n', lines):
+            lines = re.sub(rb'\s*\n\s*', b'\n', lines.strip())
+    # np.fromstring ignores whitespace such as '\r' around separators, so
+    # joining the lines only needs the newlines replaced:
+    lines = lines.replace(b'\n', b',')
+
+    # Every line has the same number of comma separated integers, so parse
+    # the whole chunk at once and fold it back into rows:
+    new_arr = np.fromstring(lines, sep=',', dtype=np.int64)
+    new_arr = new_arr.reshape((-1, __TOTAL_COLUMNS))
+
+    # Bin counts easily fit in 32 bits, halving the memory traffic of the
+    # histogram matrix compared to int64:
+    times = np.empty((new_arr.shape[0], __NON_HIST_COLUMNS + 1), dtype=np.int64)
+    times[:,0] = new_arr[:,0]
+    times[:,1] = file_idx
+    times[:,2:] = new_arr[:,1:__NON_HIST_COLUMNS]
+    hists = new_arr[:,__NON_HIST_COLUMNS:].astype(np.int32)
+    return times, hists
 
 def histogram_generator(ctx, fps, sz):
     
-    # Create a chunked pandas reader for each of the files:
-    rdrs = {}
-    for fp in fps:
-        try:
-            rdrs[fp] = pandas.read_csv(fp, dtype=int, header=None, chunksize=sz)
-        except ValueError as e:
-            if e.message == 'No columns to parse from file':
-                if ctx.warn: sys.stderr.write("WARNING: Empty input file encountered.\n")
-                rdrs[fp] = None
-            else:
-                raise(e)
-
-    # Initial histograms from disk:
-    arrs = {fp: read_chunk(rdr, sz) for fp,rdr in rdrs.items()}
-    while True:
-
-        try:
-            """ ValueError occurs when nothing more to read """
-            fp = get_min(fps, arrs)
-        except ValueError:
-            return
-        arr = arrs[fp]
-        arri = np.insert(arr[0], 1, fps.index(fp))
-        yield arri
-        arrs[fp] = arr[1:]
+    # Initial histograms from disk, not even reading from empty files:
+    arrs = [None if fp.empty else read_chunk(fp, sz, i) for i, fp in enumerate(fps)]
+    for arr in arrs:
+        if arr is None and ctx.warn:
+            sys.stderr.write("WARNING: Empty input file encountered.\n")
+
+    # Merge the files by time using a heap of (first row time, file index)
+    # for every file which still has data:
+    heap = [(arr[0][0][0], i) for i, arr in enumerate(arrs) if arr is not None]
+    heapq.heapify(heap)
+    while heap:
+        _, i = heapq.heappop(heap)
+        times, hists = arrs[i]
+        yield times[0], hists[0]
+
+        if times.shape[0] == 1:
+            arrs[i] = read_chunk(fps[i], sz, i)
+        else:
+            arrs[i] = times[1:], hists[1:]
 
-        if arrs[fp].shape[0] == 0:
-            arrs[fp] = read_chunk(rdrs[fp], sz)
+        if arrs[i] is not None:
+            heapq.heappush(heap, (arrs[i][0][0][0], i))
 
 def _plat_idx_to_val(idx, edge=0.5, FIO_IO_U_PLAT_BITS=6, FIO_IO_U_PLAT_VAL=64):
     """ Taken from fio's stat.c for calculating the latency value of a bin
         from that bin's index.
         
-            idx  : the value of the index into the histogram bins
+            idx  : the value of the index into the histogram bins, or an
+            integer array of such indices
             edge : fractional value in the range [0,1]** indicating how far into
             the bin we wish to compute the latency value of.
         
         ** edge = 0.0 and 1.0 computes the lower and upper latency bounds
            respectively of the given bin index. """
 
-    # MSB <= (FIO_IO_U_PLAT_BITS-1), cannot be rounded off. Use
-    # all bits of the sample as index
-    if (idx < (FIO_IO_U_PLAT_VAL << 1)):
-        return idx 
+    idx = np.asarray(idx, dtype=np.int64)
 
     # Find the group and compute the minimum value of that group
-    error_bits = (idx >> FIO_IO_U_PLAT_BITS) - 1 
-    base = 1 << (error_bits + FIO_IO_U_PLAT_BITS)
+    error_bits = np.maximum((idx >> FIO_IO_U_PLAT_BITS) - 1, 0)
+    base = np.left_shift(1, error_bits + FIO_IO_U_PLAT_BITS)
 
     # Find its bucket number of the group
     k = idx % FIO_IO_U_PLAT_VAL
 
-    # Return the mean (if edge=0.5) of the range of the bucket
-    return base + ((k + edge) * (1 << error_bits))
+    # MSB <= (FIO_IO_U_PLAT_BITS-1), cannot be rounded off. Use
+    # all bits of the sample as index. Otherwise return the mean (if
+    # edge=0.5) of the range of the bucket
+    return np.where(idx < (FIO_IO_U_PLAT_VAL << 1), idx.astype(float),
+                    base + ((k + edge) * np.left_shift(1, error_bits)))
     
 def plat_idx_to_val_coarse(idx, coarseness, edge=0.5):
-    """ Converts the given *coarse* index into a non-coarse index as used by fio
-        in stat.h:plat_idx_to_val(), subsequently computing the appropriate
-        latency value for that bin.
+    """ Converts the given *coarse* index (or array of indices) into a
+        non-coarse index as used by fio in stat.h:plat_idx_to_val(),
+        subsequently computing the appropriate latency value for that bin.
         """
 
     # Multiply the index by the power of 2 coarseness to get the bin
     # bin index with a max of 1536 bins (FIO_IO_U_PLAT_GROUP_NR = 24 in stat.h)
     stride = 1 << coarseness
-    idx = idx * stride
+    idx = np.asarray(idx) * stride
     lower = _plat_idx_to_val(idx, edge=0.0)
     upper = _plat_idx_to_val(idx + stride, edge=1.0)
     return lower + (upper - lower) * edge
 
-def print_all_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir):
-    ps = weighted_percentile(percs, vs, ws)
-
-    avg = weighted_average(vs, ws)
-    values = [mn, avg] + list(ps) + [mx]
+if numba_imported:
+    @njit(cache=True, inline='always')
+    def _plat_idx_to_val_jit(idx, edge, FIO_IO_U_PLAT_BITS=6, FIO_IO_U_PLAT_VAL=64):
+        """ Scalar, compiled version of _plat_idx_to_val() which can be
+            called from within other numba kernels. """
+        if idx < (FIO_IO_U_PLAT_VAL << 1):
+            return float(idx)
+        error_bits = (idx >> FIO_IO_U_PLAT_BITS) - 1
+        base = 1 << (error_bits + FIO_IO_U_PLAT_BITS)
+        k = idx % FIO_IO_U_PLAT_VAL
+        return base + ((k + edge) * (1 << error_bits))
+
+    @njit(cache=True, inline='always')
+    def bin_val_ms_jit(idx, coarseness, time_divisor):
+        """ Compiled equivalent of bin_vals_ms[idx], computed on the fly
+            in the same way as plat_idx_to_val_coarse() does. """
+        stride = 1 << coarseness
+        idx = idx * stride
+        lower = _plat_idx_to_val_jit(idx, 0.0)
+        upper = _plat_idx_to_val_jit(idx + stride, 1.0)
+        return (lower + (upper - lower) * 0.5) / time_divisor
+
+def format_all_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir):
+    """ Return the output row for the given interval as a string """
+    avg, ps = weighted_stats(percs, vs, ws, presorted=(vs is bin_vals))
+    values = np.divide([mn, avg, *ps, mx], ctx.divisor, dtype=float)
     if ctx.directions:
-        row = [end, dir, ss_cnt]
-        fmt = "%d, %s, %d, "
+        row = (end, dir, ss_cnt)
     else:
-        row = [end, ss_cnt]
-        fmt = "%d, %d, "
-    row = row + [float(x) / ctx.divisor for x in values]
-    if ctx.divisor > 1:
-        fmt = fmt + fmt_float_list(ctx, len(percs)+3)
-    else:
-        # max and min are decimal values if no divisor
-        fmt = fmt + "%d, " + fmt_float_list(ctx, len(percs)+1) + ", %d"
+        row = (end, ss_cnt)
 
-    print (fmt % tuple(row))
+    return ctx.row_fmt % (row + tuple(values))
 
-def update_extreme(val, fncn, new_val):
-    """ Calculate min / max in the presence of None values """
-    if val is None: return new_val
-    else: return fncn(val, new_val)
+def print_all_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir):
+    print (format_all_stats(ctx, end, mn, ss_cnt, vs, ws, mx, dir=dir))
 
 # See beginning of main() for how bin_vals are computed
 bin_vals = []
 lower_bin_vals = [] # lower edge of each bin
 upper_bin_vals = [] # upper edge of each bin 
+bin_vals_ms = []    # bin_vals converted to ms, the unit of the log timestamps
 
 def process_interval(ctx, iHist, iEnd, dir):
     """ print estimated percentages for the given merged sample
@@ -285,50 +383,161 @@ def process_interval(ctx, iHist, iEnd, dir):
 
 
 dir_map = ['r', 'w', 't']  # map of directional value in log to textual representation
-def process_weighted_interval(ctx, samples, iStart, iEnd, printdirs):
+
+# Weighted accumulation kernel specialized for the input files, see
+# make_accumulate():
+accumulate = None
+
+if numba_imported:
+    def make_accumulate(nbins, coarseness, time_divisor):
+        """ Compile a version of the weighted accumulation kernel for the bin
+            layout detected in main(), which is fixed for the whole run. The
+            number of bins, coarseness and time divisor become compile time
+            constants, giving the bin loop a known trip count and constant
+            folding the bin latency computation. """
+
+        @njit(parallel=True, cache=True)
+        def accumulate(dirHists, dirCounts, hists, cuts, end_times, dirs, iStart, iEnd, interval_half):
+            """ Compiled equivalent of the weights() based accumulation done in
+                process_weighted_interval: add the weighted bins of every sample
+                from its first overlapping bin (cuts) onwards to the histogram
+                of its direction and to the mixed histogram (the last row of
+                dirHists), and the unweighted bins to dirCounts in the same
+                way. Bins are independent of each other, so they are processed
+                in parallel, computing each bin's latency value in place rather
+                than reading it from bin_vals_ms. """
+            ndirs = dirHists.shape[0] - 1
+            for j in prange(nbins):
+                bin_val_ms = bin_val_ms_jit(j, coarseness, time_divisor)
+                for i in range(hists.shape[0]):
+                    h = hists[i, j]
+                    if h == 0 or j < cuts[i]:
+                        continue
+                    d = dirs[i]
+                    dirCounts[ndirs, j] += h
+                    if 0 <= d < ndirs:
+                        dirCounts[d, j] += h
+                    end_time = end_times[i]
+                    start_time = end_time - interval_half - bin_val_ms
+                    if end_time <= start_time:
+                        continue
+                    w = h * ((min(end_time, iEnd) - max(start_time, iStart)) / (end_time - start_time))
+                    dirHists[ndirs, j] += w
+                    if 0 <= d < ndirs:
+                        dirHists[d, j] += w
+
+        return accumulate
+
+def first_overlapping_bins(starts, iEnd):
+    """ Return the index of the first bin of each sample which started before
+        iEnd, i.e. the first bin for which starts - bin_vals_ms < iEnd, where
+        starts holds the end time minus half the interval of every sample.
+
+        Searching bin_vals_ms for starts - iEnd finds the cut up to rounding
+        errors, which matter for epoch timestamps. The bins within a few ulps
+        of it are settled by bisecting on the expression above, which is how
+        the start times of the bins are computed elsewhere.
+    """
+    tol = 4 * np.spacing(np.abs(starts) + abs(iEnd) + bin_vals_ms[-1])
+    lo = np.searchsorted(bin_vals_ms, (starts - iEnd) - tol, side='left')
+    hi = np.searchsorted(bin_vals_ms, (starts - iEnd) + tol, side='right')
+    active = lo < hi
+    while np.any(active):
+        mid = (lo + hi) // 2
+        before = starts - bin_vals_ms[np.minimum(mid, __HIST_COLUMNS - 1)] < iEnd
+        hi = np.where(active & before, mid, hi)
+        lo = np.where(active & ~before, mid + 1, lo)
+        active = lo < hi
+    return lo
+
+def process_weighted_interval(ctx, samples, hists, iStart, iEnd, printdirs):
     """ Construct the weighted histogram for the given interval by scanning
         through all the histograms and figuring out which of their bins have
         samples with latencies which overlap with the given interval
-        [iStart,iEnd].
+        [iStart,iEnd]. Returns the list of output rows for the interval.
     """
 
-    times, files, dirs, sizes, hists = samples[:,0], samples[:,1], samples[:,2], samples[:,3], samples[:,4:]
-    iHist={}; ss_cnt = {}; mn_bin_val={}; mx_bin_val={}
-    for dir in printdirs:
-        iHist[dir] = np.zeros(__HIST_COLUMNS, dtype=float)
-        ss_cnt[dir] = 0 # number of samples affecting this interval
-        mn_bin_val[dir] = None
-        mx_bin_val[dir] = None
-
-    for end_time,file,dir,hist in zip(times,files,dirs,hists):
-
-        # Only look at bins of the current histogram sample which
-        # started before the end of the current time interval [start,end]
-        start_times = (end_time - 0.5 * ctx.interval) - bin_vals / ctx.time_divisor
-        idx = np.where(start_times < iEnd)
-        s_ts, l_bvs, u_bvs, hs = start_times[idx], lower_bin_vals[idx], upper_bin_vals[idx], hist[idx]
-
-        # Increment current interval histogram by weighted values of future histogram
-        # total number of samples
-        # and min and max values as necessary
-        textdir = dir_map[dir]
-        ws = hs * weights(s_ts, end_time, iStart, iEnd)
-        mmidx = np.where(hs != 0)[0]
-        if 'm' in printdirs:
-            iHist['m'][idx] += ws
-            ss_cnt['m'] += np.sum(hs)
-            if mmidx.size > 0:
-                mn_bin_val['m'] = update_extreme(mn_bin_val['m'], min, l_bvs[max(0,           mmidx[0]  - 1)])
-                mx_bin_val['m'] = update_extreme(mx_bin_val['m'], max, u_bvs[min(len(hs) - 1, mmidx[-1] + 1)])
-        if textdir in printdirs:
-            iHist[textdir][idx] += ws
-            ss_cnt[textdir] += np.sum(hs)  # Update total number of samples affecting current interval histogram:
-            if mmidx.size > 0:
-                mn_bin_val[textdir] = update_extreme(mn_bin_val[textdir], min, l_bvs[max(0,           mmidx[0]  - 1)])
-                mx_bin_val[textdir] = update_extreme(mx_bin_val[textdir], max, u_bvs[min(len(hs) - 1, mmidx[-1] + 1)])
+    times, dirs = samples[:,0], samples[:,2]
+    end_times = times.reshape((len(times),1))
+    half_interval = 0.5 * ctx.interval
+
+    # Only look at bins of each histogram sample which started before the end
+    # of the current time interval [start,end]. Since bin_vals is increasing,
+    # the bins of interest of each sample form a contiguous suffix of its row:
+    cuts = first_overlapping_bins(times - half_interval, iEnd)
+
+    if numba_imported:
+        # One weighted histogram and one histogram of unweighted counts per
+        # direction, plus a final one for 'm':
+        dirHists = np.zeros((len(dir_map) + 1, __HIST_COLUMNS))
+        dirCounts = np.zeros((len(dir_map) + 1, __HIST_COLUMNS), dtype=np.int64)
+        accumulate(dirHists, dirCounts, hists, cuts, times, dirs, iStart, iEnd, half_interval)
+    else:
+        # Weighted values of every sample / bin pair, computed in a single pass
+        # over the whole N x B matrix:
+        hs = np.where(np.arange(__HIST_COLUMNS) >= cuts[:,None], hists, 0)
+        start_times = (end_times - half_interval) - bin_vals_ms
+        ws = hs * weights(start_times, end_times, iStart, iEnd)
 
+    rows = []
     for textdir in sorted(printdirs):
-        if ss_cnt[textdir] > 0: print_all_stats(ctx, iEnd, mn_bin_val[textdir], ss_cnt[textdir], bin_vals, iHist[textdir], mx_bin_val[textdir], dir=textdir)
+        if textdir == 'm':
+            sel = slice(None)
+        else:
+            sel = dirs == dir_map.index(textdir)
+
+        if numba_imported:
+            counts = dirCounts[(dir_map + ['m']).index(textdir)]
+            iHist = dirHists[(dir_map + ['m']).index(textdir)]
+        else:
+            # Unweighted number of samples in each bin, reduced over all
+            # samples at once:
+            counts = hs[sel].sum(axis=0)
+            iHist = ws[sel].sum(axis=0)
+        ss_cnt = counts.sum()
+        if ss_cnt == 0:
+            continue
+
+        # Min and max come from the lower / upper edges of the bins next to
+        # the first / last non-zero bins. The bin below the first one is only
+        # used if it started before the end of the interval for a sample
+        # which has samples in the first bin.
+        nz = np.flatnonzero(counts)
+        mn_idx, mx_idx = nz[0], min(__HIST_COLUMNS - 1, nz[-1] + 1)
+        if mn_idx > 0 and np.any(((cuts < mn_idx) & (hists[:,mn_idx] != 0))[sel]):
+            mn_idx -= 1
+        mn_bin_val, mx_bin_val = lower_bin_vals[mn_idx], upper_bin_vals[mx_idx]
+        rows.append(format_all_stats(ctx, iEnd, mn_bin_val, ss_cnt, bin_vals, iHist, mx_bin_val, dir=textdir))
+
+    return rows
+
+# Per-worker state used by process_interval_range_worker. Set by
+# init_worker() in each process of the --jobs pool:
+worker_ctx = None
+worker_printdirs = None
+
+def init_worker(ctx, printdirs, bvs, l_bvs, u_bvs, bvs_ms, hist_cols, ps):
+    """ Pool initializer: install the bin tables and output settings computed
+        in main() as module globals of the worker process. """
+    global worker_ctx,worker_printdirs,bin_vals,lower_bin_vals,upper_bin_vals,bin_vals_ms,__HIST_COLUMNS,percs,accumulate
+    worker_ctx, worker_printdirs = ctx, printdirs
+    bin_vals, lower_bin_vals, upper_bin_vals, bin_vals_ms = bvs, l_bvs, u_bvs, bvs_ms
+    __HIST_COLUMNS = hist_cols
+    percs = ps
+    if numba_imported:
+        # The pool already runs one process per job, so don't let every
+        # worker start a thread per core on top of that:
+        set_num_threads(1)
+        accumulate = make_accumulate(hist_cols, ctx.coarseness, ctx.time_divisor)
+
+def process_interval_range_worker(interval_range):
+    """ Pool worker: process every interval of a range generated by
+        weighted_interval_ranges(), returning the output rows of all of
+        them. """
+    rows = []
+    for samples, hists, iStart, iEnd in split_interval_range(worker_ctx, *interval_range):
+        rows.extend(process_weighted_interval(worker_ctx, samples, hists, iStart, iEnd, worker_printdirs))
+    return rows
 
 def guess_max_from_bins(ctx, hist_cols):
     """ Try to guess the GROUP_NR from given # of histogram
@@ -362,49 +571,120 @@ def guess_max_from_bins(ctx, hist_cols):
 
     return bins[idx[1][0]]
 
+def weighted_interval_ranges(ctx, gen, span=1):
+    """ Generate (samples, hists, firsts, lasts, kStart, kEnd) for ranges of
+        span consecutive intervals [kStart,kEnd), where samples holds the
+        (time, file, direction, block size) columns and hists the histogram
+        bins of every sample which may overlap with any interval of the
+        range, each sample appearing once. Sample i may overlap with the
+        intervals firsts[i] to lasts[i], see split_interval_range().
+
+        Intervals are aligned to multiples of ctx.interval, so each sample is
+        given the range of interval indices it may overlap with as soon as it
+        is read: from the interval ending ctx.max_latency (default 20
+        seconds) before the sample's end time, up to the interval containing
+        its end time. A range is complete once a sample ending more than
+        ctx.max_latency after the end of its last interval has been read.
+    """
+    interval = ctx.interval
+    max_latency = ctx.max_latency * 1000
+    window = []    # (sample, hist, first, last) rows still to be processed
+    k = None       # index of the first interval of the next range
+    first = None   # first interval index a newly read sample is added to
+
+    def drain(k):
+        rows = [row for row in window if row[2] < k + span]
+        window[:] = [row for row in window if row[3] >= k + span]
+        if rows:
+            samples, hists, firsts, lasts = zip(*rows)
+            return (np.vstack(samples), np.vstack(hists), np.array(firsts),
+                    np.array(lasts), k, k + span)
+        return None
+
+    for sample, hist in gen:
+        end_time = int(sample[0])
+        if k is None:
+            # Jump immediately to the start of the input, rounding
+            # down to the nearest multiple of the interval (useful when --log_unix_epoch
+            # was used to create these histograms):
+            k = 0
+            if end_time - ctx.max_latency > interval:
+                k = int((end_time - ctx.max_latency) // interval)
+            first = k
+
+        # Process all the ranges which cannot receive any more samples,
+        # skipping straight over gaps in the input:
+        first_k = int(np.floor((end_time - max_latency) / interval))
+        while k + span <= first_k:
+            if not window:
+                k = first_k
+                break
+            result = drain(k)
+            if result is not None:
+                yield result
+            k += span
+
+        first = max(first, first_k)
+        last = (end_time - 1) // interval
+        if last >= first:
+            window.append((sample, hist, first, last))
+
+    while window:
+        result = drain(k)
+        if result is not None:
+            yield result
+        k += span
+
+def split_interval_range(ctx, samples, hists, firsts, lasts, kStart, kEnd):
+    """ Generate (samples, hists, iStart, iEnd) for each interval of a range
+        generated by weighted_interval_ranges() which has any samples. """
+    for k in range(kStart, kEnd):
+        sel = (firsts <= k) & (k <= lasts)
+        if sel.all():
+            yield samples, hists, k * ctx.interval, (k + 1) * ctx.interval
+        elif sel.any():
+            yield samples[sel], hists[sel], k * ctx.interval, (k + 1) * ctx.interval
+
+def weighted_intervals(ctx, gen):
+    """ Generate (samples, hists, iStart, iEnd) for each interval, where
+        samples and hists hold every sample which may overlap with
+        [iStart,iEnd]. See weighted_interval_ranges(). """
+    for interval_range in weighted_interval_ranges(ctx, gen):
+        yield from split_interval_range(ctx, *interval_range)
+
 def output_weighted_interval_data(ctx,printdirs):
 
-    fps = [open(f, 'r') for f in ctx.FILE]
+    fps = [HistChunkRdr(f) for f in ctx.FILE]
     gen = histogram_generator(ctx, fps, ctx.buff_size)
 
     print(', '.join(columns))
 
     try:
-        start, end = 0, ctx.interval
-        arr = np.empty(shape=(0,__TOTAL_COLUMNS + 1),dtype=int)
-        more_data = True
-        while more_data or len(arr) > 0:
+        if ctx.jobs <= 1:
+            for samples, hists, start, end in weighted_intervals(ctx, gen):
+                for row in process_weighted_interval(ctx, samples, hists, start, end, printdirs):
+                    print(row)
+            return
 
-            # Read up to ctx.max_latency (default 20 seconds) of data from end of current interval.
-            while len(arr) == 0 or arr[-1][0] < ctx.max_latency * 1000 + end:
-                try:
-                    new_arr = next(gen)
-                except StopIteration:
-                    more_data = False
-                    break
-                nashape  = new_arr.reshape((1,__TOTAL_COLUMNS + 1))
-                arr = np.append(arr, nashape, axis=0)
-            #arr = arr.astype(int)
-            
-            if arr.size > 0:
-                # Jump immediately to the start of the input, rounding
-                # down to the nearest multiple of the interval (useful when --log_unix_epoch
-                # was used to create these histograms):
-                if start == 0 and arr[0][0] - ctx.max_latency > end:
-                    start = arr[0][0] - ctx.max_latency
-                    start = start - (start % ctx.interval)
-                    end = start + ctx.interval
-
-                process_weighted_interval(ctx, arr, start, end, printdirs)
-                
-                # Update arr to throw away samples we no longer need - samples which
-                # end before the start of the next interval, i.e. the end of the
-                # current interval:
-                idx = np.where(arr[:,0] > end)
-                arr = arr[idx]
-            
-            start += ctx.interval
-            end = start + ctx.interval
+        # Intervals are independent of each other, so hand out ranges of them
+        # to a pool of workers. A sample is sent along with every range it
+        # may overlap with, so make the ranges several times longer than
+        # that overlap. Keep a bounded number of ranges in flight, reading
+        # the input while the workers are busy, and print the results in
+        # order:
+        span = 4 * (int(ctx.max_latency * 1000 // ctx.interval) + 1)
+        pending = collections.deque()
+        with multiprocessing.Pool(ctx.jobs, initializer=init_worker,
+                                  initargs=(ctx, printdirs, bin_vals, lower_bin_vals,
+                                            upper_bin_vals, bin_vals_ms, __HIST_COLUMNS, percs)) as pool:
+            for interval_range in weighted_interval_ranges(ctx, gen, span):
+                pending.append(pool.apply_async(process_interval_range_worker, (interval_range,)))
+                if len(pending) > 2 * ctx.jobs:
+                    for row in pending.popleft().get():
+                        print(row)
+            while pending:
+                for row in pending.popleft().get():
+                    print(row)
     finally:
         for fp in fps:
             fp.close()
@@ -489,6 +769,9 @@ def main(ctx):
     if not hasattr(ctx, 'percentiles'):
         ctx.percentiles = "90,95,99"
 
+    if not hasattr(ctx, 'jobs'):
+        ctx.jobs = 1
+
     if ctx.directions:
         ctx.directions = ctx.directions.lower()
 
@@ -507,15 +790,19 @@ def main(ctx):
     # calculate the corresponding 'coarseness' parameter used to generate
     # those files, and calculate the appropriate bin latency values:
     with open(ctx.FILE[0], 'r') as fp:
-        global bin_vals,lower_bin_vals,upper_bin_vals,__HIST_COLUMNS,__TOTAL_COLUMNS
+        global bin_vals,lower_bin_vals,upper_bin_vals,bin_vals_ms,__HIST_COLUMNS,__TOTAL_COLUMNS,accumulate
         __TOTAL_COLUMNS = len(fp.readline().split(','))
         __HIST_COLUMNS = __TOTAL_COLUMNS - __NON_HIST_COLUMNS
 
         max_cols = guess_max_from_bins(ctx, __HIST_COLUMNS)
-        coarseness = int(np.log2(float(max_cols) / __HIST_COLUMNS))
-        bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness) for x in np.arange(__HIST_COLUMNS)], dtype=float)
-        lower_bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness, 0.0) for x in np.arange(__HIST_COLUMNS)], dtype=float)
-        upper_bin_vals = np.array([plat_idx_to_val_coarse(x, coarseness, 1.0) for x in np.arange(__HIST_COLUMNS)], dtype=float)
+        ctx.coarseness = int(np.log2(float(max_cols) / __HIST_COLUMNS))
+        idxs = np.arange(__HIST_COLUMNS)
+        bin_vals = plat_idx_to_val_coarse(idxs, ctx.coarseness)
+        lower_bin_vals = plat_idx_to_val_coarse(idxs, ctx.coarseness, 0.0)
+        upper_bin_vals = plat_idx_to_val_coarse(idxs, ctx.coarseness, 1.0)
+        bin_vals_ms = bin_vals / ctx.time_divisor
+        if numba_imported:
+            accumulate = make_accumulate(__HIST_COLUMNS, ctx.coarseness, ctx.time_divisor)
 
     # indicate which directions to output (read(0), write(1), trim(2), mixed(3))
     directions = set()
@@ -541,6 +828,11 @@ if __name__ == '__main__':
         type=int,
         help='number of samples to buffer into numpy at a time')
 
+    arg('-j', '--jobs',
+        default=1,
+        type=int,
+        help='number of worker processes used to compute weighted intervals in parallel')
+
     arg('--max_latency',
         default=20,
         type=float,